@@ -1,10 +1,20 @@
 from circularitytest.utils import load_config, load_data
-from circularitytest.gam import construct_gam_term, construct_powerset, build_gam, check_nullification, score
+from circularitytest.gam import construct_gam_term, construct_powerset, build_gam, check_nullification, \
+    check_nullification_analytic, fit_combination, memory_report, schedule_combinations, score, validated_score
 from circularitytest.plot import plot_gam_terms
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple
+from itertools import islice
 from tqdm import tqdm
 import pandas as pd
+import os
 
 
+# Result of one GAM fit, GAM, deviance_explained and edof are None if the fit timed out,
+# validated_deviance_explained is None if no validation is configured
+GAMResult = namedtuple("GAMResult", ["features", "gam", "deviance_explained", "edof", "status", "target",
+                                     "validated_deviance_explained"], defaults=[None])
+
 
 class Circularity_Test():
 
@@ -16,8 +26,109 @@ class Circularity_Test():
 
         self.full_features = sorted(list(self.config["features"]))
 
+        # target can be a single column name or a list of column names
+        target = self.config["target"]
+        self.targets = list(target) if isinstance(target, list) else [target]
+
+        # circular features of the first target, for several targets see circular_features_per_target
         self.circular_features = []
 
+        self.circular_features_per_target = {}
+
+
+    def iter_results(self, callbacks=None):
+        """
+        Fits GAMs on the powerset of given features and yields the result of each fit as soon as it is finished,
+        most expensive feature combinations first (see circularitytest.gam.schedule_combinations()).
+        Closing the generator (e.g. breaking out of the loop) cancels the fits that were not started yet.
+        :param callbacks: list of functions that are called with each GAMResult before it is yielded,
+                        if a callback returns True, the iteration stops after this result
+        :return: generator of GAMResult, one per feature combination and target
+        """
+
+        callbacks = callbacks or []
+
+        feature_combinations = construct_powerset(self.config["features"])
+
+        data_train = self.data["train"]
+        Y = data_train[1].to_numpy().reshape(len(data_train[1]), -1)
+
+        # most expensive fits first for a better load balance
+        scheduled_combinations = schedule_combinations(self.config, feature_combinations, len(Y))
+
+        budget = self.config.get("budget")
+        assert (budget or {}).get("max_iter", 1) >= 1, "budget max_iter must be at least 1"
+        n_jobs = self.config.get("n_jobs", 1)
+        validation = (self.config.get("validation") or {}).get("method")
+        assert validation or not (self.config.get("validation") or {}).get("rank"), \
+            "validation rank requires a validation method: 'loo' or 'gcv'"
+        chunk_size = (self.config.get("out_of_core") or {}).get("chunk_size")
+        sparse_basis = self.config.get("sparse_basis")
+
+        assert not (validation and chunk_size), "validation is not available for out-of-core fits"
+        assert not (chunk_size and sparse_basis is not None), "out_of_core and sparse_basis cannot be combined"
+
+        # the feature columns of a combination are sliced once for its fits and scores
+        def with_columns(feature_combination):
+            return feature_combination, data_train[0][feature_combination].to_numpy()
+
+        if n_jobs == 1:
+            fitted = ((feature_combination, X, fit_combination(self.config, feature_combination, X, Y, budget,
+                                                               chunk_size, sparse_basis))
+                      for feature_combination, X in map(with_columns, scheduled_combinations))
+            executor = None
+
+        else:
+            executor = ProcessPoolExecutor(max_workers=n_jobs)
+            futures = {}
+
+            def fit_parallel():
+                # submit lazily with at most two fits per process in flight, so that only their feature
+                # columns are copied at once instead of those of the whole powerset
+                remaining = iter(scheduled_combinations)
+                while True:
+                    for feature_combination, X in map(with_columns, islice(remaining, 2 * n_jobs - len(futures))):
+                        futures[executor.submit(fit_combination, self.config, feature_combination, X, Y, budget,
+                                                chunk_size, sparse_basis)] = feature_combination, X
+                    if not futures:
+                        return
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield futures.pop(future) + (future.result(),)
+
+            fitted = fit_parallel()
+
+        try:
+            for feature_combination, X, fit_results in fitted:
+                for j, target in enumerate(self.targets):
+                    gam, status = fit_results[j]
+
+                    if gam is None:
+                        result = GAMResult(feature_combination, None, None, None, status, target)
+                    else:
+                        validated = round(validated_score(gam, X, Y[:, j], method=validation) * 100) \
+                            if validation else None
+                        # out-of-core fits computed D² chunk by chunk already
+                        explained = gam.statistics_["pseudo_r2"]["explained_deviance"] if chunk_size \
+                            else score(gam, X, Y[:, j])
+                        result = GAMResult(feature_combination, gam, round(explained * 100),
+                                           gam.statistics_["edof"], status, target, validated)
+
+                    stop = any([callback(result) for callback in callbacks])
+
+                    yield result
+
+                    if stop:
+                        return
+
+        finally:
+            if executor is not None:
+                # cancel submitted fits and do not wait for running fits when the iteration is stopped early,
+                # the remaining feature combinations are never submitted
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+
 
     def circularity_test(self):
         """
@@ -32,76 +143,153 @@ class Circularity_Test():
         """
 
         print(f"Running circularity test for {self.config.get('name', 'given config')}")
-        gam_results = []
+        gam_results = {target: [] for target in self.targets}
 
         # Obtain feature combinations
         feature_combinations = construct_powerset(self.config["features"])
 
+        for result in tqdm(self.iter_results(), total=len(feature_combinations) * len(self.targets),
+                           desc="Fitting GAMs on Powerset of features"):
+            gam_results[result.target].append(result)
 
-        for feature_combination in tqdm(feature_combinations, desc="Fitting GAMs on Powerset of features"):
+        # collect results in powerset order for a reproducible ranking
+        order = {tuple(feature_combination): i for i, feature_combination in enumerate(feature_combinations)}
+        for target in self.targets:
+            gam_results[target].sort(key=lambda x: order[tuple(x[0])])
 
-            term_list = construct_gam_term(self.config, feature_combination)
-            gam = build_gam(term_list, self.config.get("GAM", None))
+        # rank by validated instead of training deviance explained if configured
+        fit = "validated_deviance_explained" if (self.config.get("validation") or {}).get("rank") \
+            else "deviance_explained"
 
-            data_train = self.data["train"]
-            X, y = data_train[0][feature_combination].to_numpy(), data_train[1].to_numpy()
+        # fits that timed out are listed after all finished fits
+        sorted_result_gams = {target: sorted([res for res in gam_results[target] if res[1] is not None],
+                                             key=lambda x: (getattr(x, fit), -x[3]), reverse=True)
+                                      + [res for res in gam_results[target] if res[1] is None]
+                              for target in self.targets}
 
-            gam.fit(X,y)
+        if "save_result_csv" in self.config:
+            self.store_result_table(sorted_result_gams)
 
-            result = (feature_combination, gam, round(score(gam, X, y) * 100), gam.statistics_["edof"])
+        if (self.config.get("sparse_basis") or {}).get("report"):
+            self.sparse_basis_report()
 
-            gam_results.append(result)
+        for target in self.targets:
+            if len(self.targets) == 1:
+                self.circular_features_per_target[target] = self.check_circularity(sorted_result_gams[target], fit)
+            else:
+                # report failed checks per target instead of stopping the test for all targets
+                print(f"Target {target}:")
+                try:
+                    self.circular_features_per_target[target] = self.check_circularity(sorted_result_gams[target], fit)
+                except AssertionError as e:
+                    print(e)
+                    self.circular_features_per_target[target] = []
 
-        sorted_result_gams = sorted(gam_results, key=lambda x: (x[2], -x[3]), reverse=True)
+        self.circular_features = self.circular_features_per_target[self.targets[0]]
 
-        if "save_result_csv" in self.config:
-            self.store_result_table(sorted_result_gams)
 
+    def sparse_basis_report(self):
+        """
+        Compares the GAM with all features fitted with sparse bases (config "sparse_basis") with the dense float64
+        fit of pygam, see circularitytest.gam.memory_report()
+        :return: dictionary with memory report per target
+        """
+
+        sparse_basis = self.config.get("sparse_basis") or {}
+        dtype = sparse_basis.get("dtype", "float64")
+
+        data_train = self.data["train"]
+        X = data_train[0][self.full_features].to_numpy()
+        gam = build_gam(construct_gam_term(self.config, self.full_features), self.config.get("GAM", None))
+
+        reports = {}
+        for target in self.targets:
+            report = memory_report(gam, X, self.target_values(data_train, target), dtype,
+                                   sparse_basis.get("block_size", 1024))
+            print(f"Sparse {dtype} bases{f' ({target})' if len(self.targets) > 1 else ''}: "
+                  f"{report['dense_bytes'] / 1e6:.1f} MB -> {report['sparse_bytes'] / 1e6:.1f} MB "
+                  f"({report['saved_bytes'] / 1e6:.1f} MB saved), "
+                  f"D² deviation: {report['deviance_explained_deviation'] * 100:.4f}, "
+                  f"edof deviation: {report['edof_deviation']:.4f}")
+            reports[target] = report
+
+        return reports
+
+
+    def check_circularity(self, sorted_result_gams, fit="deviance_explained"):
+        """
+        Checks the circularity conditions for the GAM results of one target
+        :param sorted_result_gams: list of tuples with GAM results, sorted by fit and degrees of freedom,
+                                    GAMs that timed out (None) at the end
+        :param fit: which fit of GAMResult to use: "deviance_explained" or "validated_deviance_explained"
+        :return: list of circular features, empty if none were found
+        """
+
+        timed_out = [elem[0] for elem in sorted_result_gams if elem[1] is None]
+        if timed_out:
+            print(f"GAMs that exceeded the time budget: {'; '.join(', '.join(elem) for elem in timed_out)}")
+
+        assert self.full_features not in timed_out, "GAM with all features exceeded the time budget"
+        sorted_result_gams = [elem for elem in sorted_result_gams if elem[1] is not None]
 
         #check that top gam is close to 1
         circularity_candidate = sorted_result_gams[0]
 
-        assert circularity_candidate[2] > self.config.get("fit_threshold", 90), "No GAM has a good fit for the data"
+        assert getattr(circularity_candidate, fit) > self.config.get("fit_threshold", 90), "No GAM has a good fit for the data"
         assert all(i > circularity_candidate[3] for i in [elem[3] for elem in sorted_result_gams if elem[0] != circularity_candidate[0]
-                                                     and circularity_candidate[2] == elem[2]]),\
+                                                     and getattr(circularity_candidate, fit) == getattr(elem, fit)]),\
                 "Best GAM does not have the smallest degrees of freedom"
 
         # if we have a circularity candidate: check for nullification in GAM with all features
         full_gam = [gam[1] for gam in sorted_result_gams if gam[0] == self.full_features][0]
 
-        nullified_features = check_nullification(full_gam, self.full_features, threshold=self.config.get("threshold", 1e-5))
+        nullification_cfg = self.config.get("nullification") or {}
+
+        if nullification_cfg.get("method", "grid") == "analytic":
+            X_full = self.data["train"][0][self.full_features].to_numpy()
+            nullified_features = check_nullification_analytic(full_gam, X_full, self.full_features,
+                                                              threshold=self.config.get("threshold", 1e-5),
+                                                              alpha=nullification_cfg.get("alpha"))
+        else:
+            nullified_features = check_nullification(full_gam, self.full_features,
+                                                     threshold=self.config.get("threshold", 1e-5))
 
         if nullified_features == sorted(list(set(self.full_features)-set(circularity_candidate[0]))):
-            self.circular_features = circularity_candidate[0]
-            print(f"Circular features found: {', '.join(self.circular_features)}")
+            print(f"Circular features found: {', '.join(circularity_candidate[0])}")
+            return circularity_candidate[0]
 
         else:
             print("No circular features were found.")
+            return []
 
 
-    def plot_term_functions(self, features, decision_funct=False):
+    def plot_term_functions(self, features, decision_funct=False, target=None):
         """
         Plot term function for GAM with given features
         :param features: list of features
         :param decision_funct: if term functions should be plotted against decision function,
                             only possible if decision function covers all elements in features
+        :param target: name of the target to fit the GAM to, default: first target
         :return:
         """
+        target = target if target is not None else self.targets[0]
+        circular_features = self.circular_features_per_target.get(target, [])
+
         # Rebuild GAM with additional plotting parameters
         term_list = construct_gam_term(self.config, features, plot=True)
         gam = build_gam(term_list, self.config.get("GAM", None))
 
         data_train = self.data["train"]
-        X, y = data_train[0][features].to_numpy(), data_train[1].to_numpy()
+        X, y = data_train[0][features].to_numpy(), self.target_values(data_train, target)
 
         gam.fit(X,y)
 
         if features == self.full_features:
             feature_str = f" all features"
-        elif self.circular_features:
-            if sorted(features) == self.circular_features:
+        elif circular_features:
+            if sorted(features) == circular_features:
                 feature_str = f" circular features"
-            elif not any(elem in self.circular_features for elem in features):
+            elif not any(elem in circular_features for elem in features):
                 feature_str = f"out circular features"
             else:
                 feature_str = f" {', '.join(features)}"
@@ -111,27 +299,57 @@ class Circularity_Test():
         bool_decision_funct = decision_funct and self.config.get("decision_function")
 
         decision_funct_str = " vs. decision function" if bool_decision_funct else ""
-        title = f"GAM with{feature_str}{decision_funct_str}, D²: {round(score(gam, X,y)*100)}%"
+        target_str = f" ({target})" if len(self.targets) > 1 else ""
+        title = f"GAM with{feature_str}{decision_funct_str}{target_str}, D²: {round(score(gam, X,y)*100)}%"
 
 
+        # export term curves so that the plot can be rendered again without refitting
+        export_path = None
+        if (self.config.get("plot") or {}).get("export"):
+            os.makedirs(self.config["plot"]["export"], exist_ok=True)
+            file_name = "_".join([self.config.get("name", "gam")] + features) \
+                        + ("_decision_function" if bool_decision_funct else "") \
+                        + (f"_{target}" if len(self.targets) > 1 else "")
+            export_path = os.path.join(self.config["plot"]["export"], f"{file_name}.npz")
+
         plot_gam_terms(self.config.get("plot", {}), gam, features,
-                       circular_features=self.circular_features, title=title,
+                       circular_features=circular_features, title=title,
                        decision_funct=self.config.get("decision_function") if bool_decision_funct else None,
-                       logistic= "binomial" == (self.config.get("GAM") or {}).get("distribution", "normal"))
+                       logistic= "binomial" == (self.config.get("GAM") or {}).get("distribution", "normal"),
+                       export_path=export_path)
 
-    def store_result_table(self, sorted_result_gams):
+    def target_values(self, data_part, target):
         """
-        Stores the result for all the GAMs trained on the powerset of features to csv.
-        :param sorted_result_gams: list of tuples with GAM results
-        :return:
+        Get the values of one target from a data part
+        :param data_part: list of [features DataFrame, target Series/ DataFrame], e.g. self.data["train"]
+        :param target: name of the target
+        :return: np.array of shape (n_samples)
         """
 
-        df = pd.DataFrame(sorted_result_gams,
-                          columns=['Features', 'GAM', 'Deviance Explained', "Effective Degrees of Freedom"]).drop('GAM', 1)
-        df.to_csv(self.config.get("save_result_csv"))
+        y = data_part[1]
 
+        if isinstance(y, pd.DataFrame):
+            y = y[target]
 
+        return y.to_numpy()
 
+    def store_result_table(self, sorted_result_gams):
+        """
+        Stores the result for all the GAMs trained on the powerset of features to csv.
+        :param sorted_result_gams: dictionary with list of tuples with GAM results for each target
+        :return:
+        """
 
+        columns = ['Features', 'GAM', 'Deviance Explained', "Effective Degrees of Freedom", "Status", "Target",
+                   "Validated Deviance Explained"]
 
+        if len(self.targets) == 1:
+            df = pd.DataFrame(sorted_result_gams[self.targets[0]], columns=columns).drop(columns=['GAM', 'Target'])
+        else:
+            df = pd.concat([pd.DataFrame(sorted_result_gams[target], columns=columns).drop(columns=['GAM'])
+                            for target in self.targets], ignore_index=True)
+
+        if not (self.config.get("validation") or {}).get("method"):
+            df = df.drop(columns=["Validated Deviance Explained"])
 
+        df.to_csv(self.config.get("save_result_csv"))
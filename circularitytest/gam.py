@@ -1,7 +1,17 @@
 from pygam import GAM, s, l, te, f, LogisticGAM
-from pygam.terms import TermList
+from pygam.terms import TermList, SplineTerm
+from pygam.distributions import NormalDist
+from pygam.links import IdentityLink
+from pygam.utils import check_X, check_y, OptimizationError
+from pygam.callbacks import CallBack, validate_callback
 from itertools import combinations
+from collections import defaultdict
+from copy import deepcopy
+import time
 import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.stats
 
 
 def construct_powerset(feature_list):
@@ -20,6 +30,47 @@ def construct_powerset(feature_list):
     return feature_combinations
 
 
+def estimate_fit_cost(cfg, features, n_rows):
+    """
+    Estimates the relative cost of fitting a GAM on a feature combination from its term specification:
+    each PIRLS iteration is dominated by the QR decomposition of the (n_rows x n_coefs) model matrix
+    :param cfg: dictionary with term specifications, see construct_gam_term()
+                -> Circularity_Test.config
+    :param features: list of feature names
+    :param n_rows: number of training samples
+    :return: estimated cost (arbitrary unit, only meaningful relative to other combinations)
+    """
+
+    def n_coefs(term_info):
+        # tensor terms: product of the bases of their marginal terms
+        if term_info["term_type"] == "tensor_term":
+            return int(np.prod([n_coefs(info) for info in term_info["terms"]]))
+        if term_info["term_type"] == "linear_term":
+            return 1
+        return term_info.get("n_splines", 1)
+
+    term_list = construct_gam_term(cfg, features)
+
+    # + 1 for the intercept
+    total_coefs = 1 + sum(n_coefs(info) for info in term_list.info["terms"])
+
+    return n_rows * total_coefs ** 2
+
+
+def schedule_combinations(cfg, feature_combinations, n_rows):
+    """
+    Orders feature combinations longest-first by their estimated fit cost (see estimate_fit_cost()),
+    so that expensive fits do not end up last when fitting in parallel
+    :param cfg: dictionary with term specifications
+                -> Circularity_Test.config
+    :param feature_combinations: nested list of feature combinations, e.g. from construct_powerset()
+    :param n_rows: number of training samples
+    :return: nested list of feature combinations, most expensive first
+    """
+
+    return sorted(feature_combinations, key=lambda features: estimate_fit_cost(cfg, features, n_rows), reverse=True)
+
+
 def construct_gam_term(cfg, features, plot=False):
     """
     Construct gam term from feature list and config specifications
@@ -105,6 +156,604 @@ def build_gam(term, cfg=None):
     return gam
 
 
+class FitTimeout(Exception):
+    """
+    Raised when fitting a GAM exceeds its time budget
+    """
+    pass
+
+
+@validate_callback
+class TimeBudget(CallBack):
+    """
+    pygam CallBack that stops the PIRLS iterations of a fit by raising FitTimeout once the time budget is exceeded.
+    The budget is checked at the end of each PIRLS iteration, fits that converged in this iteration are kept.
+    """
+
+    def __init__(self, seconds):
+        """
+        :param seconds: time budget for the fit in seconds, starts counting when the CallBack is created,
+                        so create one CallBack per fit
+        """
+        super(TimeBudget, self).__init__(name="time_budget")
+        self.seconds = seconds
+        self.start = time.time()
+
+    def on_loop_end(self, diff, gam):
+        if diff >= gam.tol and time.time() - self.start > self.seconds:
+            raise FitTimeout(f"Fit exceeded time budget of {self.seconds}s")
+        return time.time() - self.start
+
+
+def fit_target(gam, X, y, chunk_size=None, sparse_basis=None):
+    """
+    Fits a copy of an (unfitted) GAM for one target with pygam, out-of-core (see fit_chunked()) or with
+    sparse bases (see fit_sparse())
+    :param gam: unfitted GAM, e.g. from build_gam()
+    :param X: Training vectors in shape (n_samples, m_features)
+    :param y: Target values in shape (n_samples)
+    :param chunk_size: if given, the GAM is fitted out-of-core in chunks of this many rows
+    :param sparse_basis: if given, the GAM is fitted with sparse bases, e.g. {"dtype": "float32"}
+    :return: fitted GAM
+    """
+
+    if chunk_size:
+        return fit_chunked(gam, X, y, chunk_size)
+    if sparse_basis is not None:
+        return fit_sparse(gam, X, y, sparse_basis.get("dtype", "float64"), sparse_basis.get("block_size", 1024))
+    return deepcopy(gam).fit(X, y)
+
+
+def fit_combination(cfg, feature_combination, X, Y, budget=None, chunk_size=None, sparse_basis=None):
+    """
+    Builds and fits the GAMs of one feature combination for all targets within an optional budget per fit
+    :param cfg: dictionary with term and GAM specifications
+                -> Circularity_Test.config
+    :param feature_combination: list of feature names
+    :param X: Training vectors in shape (n_samples, m_features)
+    :param Y: Target values in shape (n_samples, n_targets)
+    :param budget: dictionary with budget per fit (i.e. per target), e.g. {"time": 60, "max_iter": 50}
+            - time: seconds after which the PIRLS iterations are stopped, checked at the end of each iteration;
+                    not applied to dense fits of GAMs with normal distribution and identity link
+                    (see shares_factorisation()), which are solved in one step, but to their out-of-core and
+                    sparse fits, which iterate
+            - max_iter: maximum number of PIRLS iterations
+            -> Circularity_Test.config["budget"]
+    :param chunk_size: if given, the GAMs are fitted out-of-core in chunks of this many rows (see fit_chunked())
+            -> Circularity_Test.config["out_of_core"]["chunk_size"]
+    :param sparse_basis: if given, the GAMs are fitted with sparse bases (see fit_sparse()), e.g. {"dtype": "float32"}
+            - dtype: dtype of the bases and their cross-products, default: "float64"
+            - block_size: number of rows per block, default: 1024
+            -> Circularity_Test.config["sparse_basis"]
+    :return: list of (GAM, status) per target; status is "ok", "max_iter" if the fit did not converge
+            within max_iter iterations or "timeout" (GAM is None then)
+    """
+
+    budget = budget or {}
+
+    term_list = construct_gam_term(cfg, feature_combination)
+    gam = build_gam(term_list, cfg.get("GAM", None))
+
+    if "max_iter" in budget:
+        gam.max_iter = budget["max_iter"]
+
+    # only the dense fit of Gaussian GAMs (see fit_multi_target()) is solved in one step
+    multi_target = not chunk_size and sparse_basis is None and shares_factorisation(validated_copy(gam))
+    timed = "time" in budget and not multi_target
+
+    if not multi_target:
+        gams = []
+        for j in range(Y.shape[1]):
+            target_gam = deepcopy(gam)
+            if timed:
+                # new CallBack per target, so that the clock starts with each fit
+                target_gam.callbacks = list(gam.callbacks) + [TimeBudget(budget["time"])]
+            try:
+                gams.append(fit_target(target_gam, X, Y[:, j], chunk_size, sparse_basis))
+            except FitTimeout:
+                gams.append(None)
+    else:
+        gams = fit_multi_target(gam, X, Y)
+
+    results = []
+    for gam in gams:
+        if gam is None:
+            results.append((None, "timeout"))
+            continue
+        # GAMs fitted with shared factorisation are solved directly, the others log their PIRLS diffs
+        diffs = gam.logs_.get("diffs")
+        converged = not diffs or diffs[-1] < gam.tol
+        results.append((gam, "ok" if converged else "max_iter"))
+
+    return results
+
+
+def shares_factorisation(gam):
+    """
+    Whether the fit of a GAM is linear in the target, i.e. normal distribution with identity link and without
+    constraints: then the factorisation of design and penalty matrix can be reused for several targets
+    :param gam: GAM with validated parameters
+    :return: bool
+    """
+
+    return isinstance(gam.distribution, NormalDist) and isinstance(gam.link, IdentityLink) \
+        and not gam.terms.hasconstraint
+
+
+def validated_copy(gam):
+    """
+    Copies an (unfitted) GAM and validates its parameters as GAM.fit() does, e.g. max_iter >= 1
+    :param gam: unfitted GAM, e.g. from build_gam()
+    :return: copy of the GAM with validated parameters
+    """
+
+    gam = deepcopy(gam)
+    gam._validate_params()
+
+    return gam
+
+
+def prepare_fit(gam, X, n_samples=None, m_features=None):
+    """
+    Same set-up as GAM.fit() for a GAM with validated parameters (see validated_copy())
+    :param gam: GAM with validated parameters, is modified
+    :param X: data for the data-dependent parameters (e.g. edge knots), i.e. the training vectors or a summary of
+            them (see data_summary())
+    :param n_samples: number of training samples, default: len(X)
+    :param m_features: number of features, default: X.shape[1]
+    """
+
+    gam._validate_data_dep_params(X)
+    gam.logs_ = defaultdict(list)
+    gam.statistics_ = {"n_samples": len(X) if n_samples is None else n_samples,
+                       "m_features": X.shape[1] if m_features is None else m_features}
+
+
+def valid_weights(w):
+    """
+    Mask of GAM._mask() for the weights of a chunk of rows. GAM._mask() raises on a chunk without valid weights,
+    the chunked fits skip such chunks instead and only raise if no row is valid (see check_valid_rows())
+    :param w: diagonal of the PIRLS weight matrix W of the chunk
+    :return: boolean mask of the valid rows
+    """
+
+    return (np.abs(w) >= np.sqrt(np.finfo(np.float64).eps)) & np.isfinite(w)
+
+
+def check_valid_rows(n_valid):
+    """
+    Raises pygam's error for a PIRLS iteration without valid weights (see valid_weights())
+    :param n_valid: number of valid rows over all chunks
+    """
+
+    if n_valid == 0:
+        raise OptimizationError("PIRLS optimization has diverged.\n"
+                                "Try increasing regularization, or specifying an initial value for self.coef_")
+
+
+def penalty_cholesky(gam):
+    """
+    Cholesky factor E of the penalties as in GAM._pirls(), E^T E = P (+ C) plus a small ridge
+    :param gam: GAM in the PIRLS iterations
+    :return: E as np.array in shape (m_coefs, m_coefs)
+    """
+
+    S = scipy.sparse.diags(np.ones(gam.terms.n_coefs) * np.sqrt(np.finfo(np.float64).eps))  # improve condition
+    return gam._cholesky(S + gam._P() + (gam._C() if gam.terms.hasconstraint else 0), sparse=False,
+                         verbose=gam.verbose)
+
+
+def svd_update(R, E):
+    """
+    Coefficient update of GAM._pirls() from the SVD of the R factor of the weighted model matrix WB = Q R stacked
+    on the cholesky factor E of the penalties
+    :param R: R factor of WB in shape (min(n_samples, m_coefs), m_coefs)
+    :param E: cholesky factor of the penalties in shape (m_coefs, m_coefs)
+    :return: BQ and U1 with B = BQ Q^T as in GAM._pirls(), i.e. coefficients BQ Q^T z and covariance B B^T
+    """
+
+    m = E.shape[1]
+    U, d, Vt = np.linalg.svd(np.vstack([R, E]))
+
+    min_n_m = min(m, R.shape[0])
+    Dinv = np.zeros((m, min_n_m))
+    np.fill_diagonal(Dinv, d ** -1)
+    U1 = U[:min_n_m, :min_n_m]
+
+    return Vt.T.dot(Dinv).dot(U1.T), U1
+
+
+def update_coef(gam, coef_new):
+    """
+    Ends a PIRLS iteration: sets the new coefficients, logs their relative change and checks the time budget
+    (see TimeBudget), other pygam callbacks need the full data
+    :param gam: GAM in the PIRLS iterations
+    :param coef_new: coefficients of the iteration
+    :return: relative change of the coefficients
+    """
+
+    diff = np.linalg.norm(gam.coef_ - coef_new) / np.linalg.norm(coef_new)
+    gam.coef_ = coef_new
+    gam.logs_["diffs"].append(diff)
+
+    for callback in gam.callbacks:
+        if isinstance(callback, TimeBudget):
+            callback.on_loop_end(diff=diff, gam=gam)
+
+    return diff
+
+
+def report_convergence(gam):
+    """
+    Prints pygam's message if the PIRLS iterations did not converge
+    :param gam: fitted GAM
+    """
+
+    if gam.logs_["diffs"][-1] >= gam.tol:
+        print("did not converge")
+
+
+def fit_multi_target(gam, X, Y):
+    """
+    Fits a copy of an (unfitted) GAM for each target in Y.
+    For Gaussian GAMs (see shares_factorisation()) the model matrix, the cholesky factor of the penalties and
+    the QR/SVD factorisation used by pygam's PIRLS are computed once and the coefficients for all targets are
+    obtained by solving with multiple right-hand sides. Otherwise each target is fitted separately.
+    :param gam: unfitted GAM, e.g. from build_gam()
+    :param X: Training vectors in shape (n_samples, m_features)
+    :param Y: Target values in shape (n_samples, n_targets) or (n_samples)
+    :return: list of fitted GAMs, one per target (column of Y)
+    """
+
+    Y = np.asarray(Y, dtype="float64").reshape(len(X), -1)
+
+    base = validated_copy(gam)
+
+    if Y.shape[1] == 1 or not shares_factorisation(base):
+        return [deepcopy(gam).fit(X, Y[:, j]) for j in range(Y.shape[1])]
+
+    for j in range(Y.shape[1]):
+        check_y(Y[:, j], base.link, base.distribution, verbose=base.verbose)
+    X = check_X(X, verbose=base.verbose)
+    prepare_fit(base, X)
+
+    # one PIRLS step with identity weights as in GAM._pirls(), which is exact for the Gaussian case
+    modelmat = base._modelmat(X)
+    n = modelmat.shape[0]
+
+    Q, R = np.linalg.qr(modelmat.toarray())
+    BQ, U1 = svd_update(R, penalty_cholesky(base))
+    B = BQ.dot(Q.T)
+
+    # all targets at once
+    coefs = B.dot(Y)
+
+    weights = np.ones(n)
+    gams = []
+    for j in range(Y.shape[1]):
+        fitted = deepcopy(base)
+        fitted.coef_ = coefs[:, j]
+        fitted._estimate_model_statistics(Y[:, j], modelmat, BW=modelmat.T, B=B, weights=weights, U1=U1)
+        gams.append(fitted)
+
+    return gams
+
+
+def iter_chunks(n_rows, chunk_size):
+    """
+    Splits rows into consecutive chunks
+    :param n_rows: number of rows
+    :param chunk_size: maximum number of rows per chunk
+    :return: generator of slices
+    """
+
+    for start in range(0, n_rows, chunk_size):
+        yield slice(start, min(start + chunk_size, n_rows))
+
+
+def data_summary(X, chunk_size, columns=None, categorical=()):
+    """
+    Summarises data in chunks for the data-dependent parameters of pygam terms: the edge knots of numerical
+    features only depend on their minimum and maximum, those of categorical features on their unique values
+    :param X: array-like in shape (n_samples, m_features) that can be sliced by rows, e.g. np.memmap
+    :param chunk_size: number of rows to read at once
+    :param columns: indices of the columns in X to use, default: all
+    :param categorical: indices (after column selection) of categorical features
+    :return: small np.array with the same minimum, maximum and unique values of categorical features per column as X
+    """
+
+    mins, maxs, levels = None, None, {i: set() for i in categorical}
+
+    for rows in iter_chunks(len(X), chunk_size):
+        chunk = np.asarray(X[rows], dtype="float64")
+        chunk = chunk[:, columns] if columns is not None else chunk
+
+        mins = chunk.min(axis=0) if mins is None else np.minimum(mins, chunk.min(axis=0))
+        maxs = chunk.max(axis=0) if maxs is None else np.maximum(maxs, chunk.max(axis=0))
+        for i in levels:
+            levels[i].update(np.unique(chunk[:, i]))
+
+    n_summary_rows = max([2] + [len(values) for values in levels.values()])
+    summary = np.vstack([mins] + [maxs] * (n_summary_rows - 1))
+
+    for i, values in levels.items():
+        values = sorted(values)
+        summary[:, i] = values + [values[-1]] * (n_summary_rows - len(values))
+
+    return summary
+
+
+def fit_chunked(gam, X, y, chunk_size=100000, columns=None):
+    """
+    Fits a GAM out-of-core: the data is read in row chunks (e.g. from a np.memmap) and each PIRLS iteration
+    accumulates the QR decomposition of the weighted model matrix chunk by chunk, so that memory is bounded by
+    chunk_size x number of coefficients instead of the number of rows.
+    Coefficient update, edof, covariance and D² are computed as in pygam's GAM._pirls().
+    :param gam: unfitted GAM, e.g. from build_gam(), e.g. with binomial distribution
+    :param X: array-like in shape (n_samples, m_features) that can be sliced by rows, e.g. np.memmap
+    :param y: Target values in shape (n_samples), can be sliced like X
+    :param chunk_size: number of rows to process at once
+    :param columns: indices of the columns in X that the GAM uses (in this order), default: all
+    :return: fitted GAM
+    """
+
+    gam = validated_copy(gam)
+
+    def read(rows):
+        chunk = np.asarray(X[rows], dtype="float64")
+        return chunk[:, columns] if columns is not None else chunk, np.asarray(y[rows], dtype="float64")
+
+    def term_infos(info):
+        return [i for sub in info["terms"] for i in term_infos(sub)] if "terms" in info else [info]
+
+    categorical = sorted({info["feature"] for info in term_infos(gam.terms.info)
+                          if info["term_type"] == "factor_term" or info.get("dtype") == "categorical"})
+
+    # data-dependent parameters from a summary of the data
+    n = len(y)
+    prepare_fit(gam, data_summary(X, chunk_size, columns, categorical), n_samples=n,
+                m_features=len(columns) if columns is not None else X.shape[1])
+
+    m = gam.terms.n_coefs
+    weights = np.ones(min(chunk_size, n))
+    sqrt_eps = np.sqrt(np.finfo(np.float64).eps)
+
+    def chunk_state(rows):
+        X_chunk, y_chunk = read(rows)
+        modelmat = gam._modelmat(X_chunk)
+        lp = gam._linear_predictor(modelmat=modelmat)
+        mu = gam.link.mu(lp, gam.distribution)
+        return modelmat, y_chunk, lp, mu
+
+    # initial estimate as in GAM._initial_estimate(): unpenalized solve on the linear scale
+    gram, rhs = np.zeros((m, m)), np.zeros(m)
+    for rows in iter_chunks(n, chunk_size):
+        X_chunk, y_chunk = read(rows)
+        modelmat = gam._modelmat(X_chunk)
+        y_chunk = y_chunk.copy()
+        y_chunk[y_chunk == 0] += 0.01  # edge case for log link, inverse link, and logit link
+        y_chunk[y_chunk == 1] -= 0.01  # edge case for logit link
+        gram += modelmat.T.dot(modelmat).toarray()
+        rhs += modelmat.T.dot(gam.link.link(y_chunk, gam.distribution))
+    gam.coef_ = np.linalg.solve(gram + np.eye(m) * sqrt_eps, rhs)
+
+    for _ in range(gam.max_iter):
+
+        E = penalty_cholesky(gam)
+
+        # QR decomposition of the weighted model matrix, updated chunk by chunk: only R and Q^T z are kept
+        R, Qz = np.zeros((0, m)), np.zeros(0)
+        for rows in iter_chunks(n, chunk_size):
+            modelmat, y_chunk, lp, mu = chunk_state(rows)
+            W = gam._W(mu, weights[:len(y_chunk)], y_chunk)
+
+            mask = valid_weights(W.diagonal())
+            if not mask.any():
+                continue
+            WB = W.dot(modelmat)[mask, :].toarray()
+            pseudo_data = (W.dot(gam._pseudo_data(y_chunk, lp, mu)))[mask]
+
+            Q, R = np.linalg.qr(np.vstack([R, WB]))
+            Qz = Q.T.dot(np.concatenate([Qz, pseudo_data]))
+
+        check_valid_rows(len(R))
+
+        # same update as GAM._pirls(): coefficients from Q^T z, covariance from B B^T = BQ BQ^T
+        BQ, U1 = svd_update(R, E)
+        if update_coef(gam, BQ.dot(Qz[:len(U1)])) < gam.tol:
+            break
+
+    # statistics as in GAM._estimate_model_statistics(), sums over chunks
+    gam.statistics_["edof_per_coef"] = np.diagonal(U1.dot(U1.T))
+    gam.statistics_["edof"] = gam.statistics_["edof_per_coef"].sum()
+
+    edof = gam.statistics_["edof"]
+    y_mean = sum(np.asarray(y[rows], dtype="float64").sum() for rows in iter_chunks(n, chunk_size)) / n
+
+    if not gam.distribution._known_scale:
+        # distribution.phi() summed over chunks
+        pearson = 0
+        for rows in iter_chunks(n, chunk_size):
+            modelmat, y_chunk, lp, mu = chunk_state(rows)
+            pearson += np.sum(weights[:len(y_chunk)] * gam.distribution.V(mu) ** -1 * (y_chunk - mu) ** 2)
+        gam.distribution.scale = pearson / (n - edof)
+
+    full_d, null_d, full_ll, null_ll, dev = 0, 0, 0, 0, 0
+    for rows in iter_chunks(n, chunk_size):
+        modelmat, y_chunk, lp, mu = chunk_state(rows)
+        null_mu = y_mean * np.ones_like(y_chunk)
+        chunk_weights = weights[:len(y_chunk)]
+        full_d += gam.distribution.deviance(y=y_chunk, mu=mu, weights=chunk_weights).sum()
+        null_d += gam.distribution.deviance(y=y_chunk, mu=null_mu, weights=chunk_weights).sum()
+        dev += gam.distribution.deviance(y=y_chunk, mu=mu, scaled=False, weights=chunk_weights).sum()
+        full_ll += gam._loglikelihood(y_chunk, mu, weights=chunk_weights)
+        null_ll += gam._loglikelihood(y_chunk, null_mu, weights=chunk_weights)
+
+    scale = gam.distribution.scale
+    gamma = 1.4  # default of GAM._estimate_GCV_UBRE()
+    gam.statistics_["scale"] = scale
+    gam.statistics_["cov"] = BQ.dot(BQ.T) * scale
+    gam.statistics_["se"] = gam.statistics_["cov"].diagonal() ** 0.5
+    gam.statistics_["AIC"] = -2 * full_ll + 2 * edof + 2 * (not gam.distribution._known_scale)
+    gam.statistics_["AICc"] = gam.statistics_["AIC"] + 2 * (edof + 1) * (edof + 2) / (n - edof - 2)
+    gam.statistics_["pseudo_r2"] = {"explained_deviance": 1.0 - full_d / null_d,
+                                    "McFadden": full_ll / null_ll,
+                                    "McFadden_adj": 1.0 - (full_ll - edof) / null_ll}
+    if gam.distribution._known_scale:
+        # matches GAM._estimate_GCV_UBRE(add_scale=True)
+        gam.statistics_["GCV"], gam.statistics_["UBRE"] = None, dev / n + 2 * scale + 2.0 * gamma / n * edof * scale
+    else:
+        gam.statistics_["GCV"], gam.statistics_["UBRE"] = (n * dev) / (n - gamma * edof) ** 2, None
+    gam.statistics_["loglikelihood"] = full_ll
+    gam.statistics_["deviance"] = full_d
+    gam.statistics_["p_values"] = gam._estimate_p_values()
+
+    report_convergence(gam)
+
+    return gam
+
+
+def fit_sparse(gam, X, y, dtype="float64", block_size=1024):
+    """
+    Fits a GAM without densifying its model matrix: the spline bases stay in pygam's sparse form (optionally in
+    float32) and each PIRLS iteration accumulates the cross-products B^T W² B block by block instead of the QR
+    decomposition of the dense n x m matrix WB as in pygam's GAM._pirls(). The products of each block are
+    computed in the given precision and summed up in float64, the gradient of the penalized objective is always
+    computed in float64, so that the iterations converge to the float64 solution (iterative refinement).
+    edof and covariance are computed from the cross-products in float64 after convergence.
+    Memory of a fit is bounded by the non-zero entries of the bases plus m x m instead of n x m.
+    :param gam: unfitted GAM, e.g. from build_gam()
+    :param X: Training vectors in shape (n_samples, m_features)
+    :param y: Target values in shape (n_samples)
+    :param dtype: dtype of the bases and their cross-products, "float64" or "float32"
+    :param block_size: number of rows per block
+    :return: fitted GAM
+    """
+
+    gam = validated_copy(gam)
+
+    y = check_y(y, gam.link, gam.distribution, verbose=gam.verbose)
+    X = check_X(X, verbose=gam.verbose)
+    prepare_fit(gam, X)
+
+    n = len(y)
+    modelmat = scipy.sparse.vstack([gam._modelmat(X[rows]).astype(dtype) for rows in iter_chunks(n, block_size)],
+                                   format="csr")
+    m = modelmat.shape[1]
+    weights = np.ones(n)
+
+    gam.coef_ = gam._initial_estimate(y, modelmat).ravel().astype("float64")
+
+    def cross_products(precision):
+        # H = B^T W² B accumulated in the given precision and cast to float64, gradient B^T W² (z - lp) in float64
+        H, gradient, n_valid = np.zeros((m, m)), np.zeros(m), 0
+        for rows in iter_chunks(n, block_size):
+            block = modelmat[rows]
+            lp = block.astype("float64").dot(gam.coef_)
+            mu = gam.link.mu(lp, gam.distribution)
+            w = gam._W(mu, weights[rows], y[rows]).diagonal()
+
+            mask = valid_weights(w)
+            if not mask.any():
+                continue
+            n_valid += mask.sum()
+
+            WB = block[mask].astype(precision).multiply(w[mask, None].astype(precision)).tocsr()
+            H += WB.T.dot(WB).toarray()
+            gradient += block[mask].astype("float64").T.dot(
+                w[mask] ** 2 * (gam._pseudo_data(y[rows], lp, mu) - lp)[mask])
+
+        check_valid_rows(n_valid)
+
+        return H, gradient
+
+    precision, previous_diff = dtype, np.inf
+    for _ in range(gam.max_iter):
+
+        E = penalty_cholesky(gam)
+        EtE = E.T.dot(E)
+
+        # iterative refinement: the step solves with H from the precision of the iterations, cast to float64, but
+        # the gradient is always float64, so the fixed point is that of the float64 fit. The rounding error of H
+        # makes it indefinite in the null directions of the collinear bases; the shift by twice its most negative
+        # eigenvalue keeps the factorisation positive definite
+        H, gradient = cross_products(precision)
+        gradient -= EtE.dot(gam.coef_)
+        shift = 2 * max(0, -scipy.linalg.eigvalsh(H, subset_by_index=[0, 0])[0])
+        step = scipy.linalg.cho_factor(H + EtE + shift * np.eye(m))
+        diff = update_coef(gam, gam.coef_ + scipy.linalg.cho_solve(step, gradient))
+        if diff < gam.tol:
+            break
+
+        # refinement converges linearly at a rate given by the rounding error of H, which can be close to one (large
+        # blocks, nearly separable binomial data): if an iteration does not reduce the change by a factor of four,
+        # the remaining iterations use float64 cross products of the same reduced-precision basis
+        if diff > previous_diff / 4:
+            precision = "float64"
+        previous_diff = diff
+
+    # statistics from H in float64, reduced precision is only used for the iterations
+    if np.dtype(precision) != np.float64:
+        H, _ = cross_products("float64")
+
+    # B-spline bases sum to one, so the bases of several terms are collinear with the intercept: directions in
+    # which H vanishes up to its rounding error are treated as zero
+    eigenvalues, eigenvectors = np.linalg.eigh(H)
+    tol = np.finfo(np.float64).eps * np.sqrt(m * block_size) * eigenvalues.max()
+
+    # pygam's statistics only need B B^T and U1 U1^T: with R^T R = H (R as in the QR decomposition of WB) and
+    # L L^T = H + E^T E these are (L L^T)^-1 H (L L^T)^-1 and R (L L^T)^-1 R^T, i.e. B = (L L^T)^-1 R^T and U1 = R L^-T
+    eigenvalues[eigenvalues < tol] = 0
+    R = np.linalg.qr(np.sqrt(eigenvalues)[:, None] * eigenvectors.T, mode="r")
+    cho = scipy.linalg.cho_factor(R.T.dot(R) + E.T.dot(E), lower=True)
+    B = scipy.linalg.cho_solve(cho, R.T)
+    U1 = scipy.linalg.solve_triangular(cho[0], R.T, lower=True).T
+
+    gam._estimate_model_statistics(y, modelmat, B=B, weights=weights, U1=U1)
+
+    report_convergence(gam)
+
+    return gam
+
+
+def memory_report(gam, X, y, dtype="float64", block_size=1024):
+    """
+    Compares the sparse fit (see fit_sparse()) with pygam's dense float64 fit of a GAM
+    :param gam: unfitted GAM, e.g. from build_gam()
+    :param X: Training vectors in shape (n_samples, m_features)
+    :param y: Target values in shape (n_samples)
+    :param dtype: dtype of the bases and their cross-products in the sparse fit
+    :param block_size: number of rows per block in the sparse fit
+    :return: dictionary with
+            - dense_bytes: size of the sparse float64 model matrix, the dense weighted model matrix and its Q factor
+                in pygam's PIRLS
+            - sparse_bytes: size of the sparse model matrix in the given dtype, its weighted copy per block and the
+                m x m cross-products
+            - saved_bytes: dense_bytes - sparse_bytes
+            - deviance_explained_deviation: absolute difference of D²
+            - edof_deviation: absolute difference of the effective degrees of freedom
+    """
+
+    dense = deepcopy(gam).fit(X, y)
+    sparse = fit_sparse(gam, X, y, dtype=dtype, block_size=block_size)
+
+    modelmat = sparse._modelmat(X).tocsr()
+    n, m = modelmat.shape
+    index_bytes = modelmat.indices.nbytes + modelmat.indptr.nbytes
+    nnz_per_row = modelmat.nnz / n
+
+    dense_bytes = modelmat.data.nbytes + index_bytes + 2 * n * m * np.dtype("float64").itemsize
+    sparse_bytes = modelmat.nnz * np.dtype(dtype).itemsize + index_bytes \
+        + int(min(block_size, n) * nnz_per_row) * (np.dtype(dtype).itemsize + modelmat.indices.itemsize) \
+        + 2 * m * m * np.dtype("float64").itemsize
+
+    return {"dense_bytes": dense_bytes,
+            "sparse_bytes": sparse_bytes,
+            "saved_bytes": dense_bytes - sparse_bytes,
+            "deviance_explained_deviation": abs(score(dense, X, y) - score(sparse, X, y)),
+            "edof_deviation": abs(dense.statistics_["edof"] - sparse.statistics_["edof"])}
+
+
 def check_nullification(full_gam, feature_combination_full, threshold = 1e-7):
     """
     Check for nullification of features in GAM using the standard deviation of a smooth term
@@ -129,6 +778,169 @@ def check_nullification(full_gam, feature_combination_full, threshold = 1e-7):
     return nullified_features
 
 
+def term_variances(gam, modelmat, n_terms):
+    """
+    Compute the variance of each term function over the empirical feature distribution directly from the
+    coefficients of the GAM, without evaluating the term functions on a grid.
+    For term i with basis columns B_i and coefficients b_i: Var(f_i) = b_i^T Cov(B_i) b_i
+    :param gam: fitted GAM
+    :param modelmat: model matrix of the GAM evaluated at the data, e.g. gam._modelmat(X);
+                    can be computed once and reused for all terms
+    :param n_terms: number of (feature) terms to compute the variance for, the terms have to be the
+                    first n_terms terms of the GAM
+    :return: np.array of shape (n_terms,) with the variance of each term function
+    """
+
+    n = modelmat.shape[0]
+
+    # empirical covariance of the basis columns: B^T B / n - mean mean^T
+    mean = np.asarray(modelmat.mean(axis=0)).ravel()
+    gram = modelmat.T.dot(modelmat)
+    gram = gram.toarray() if scipy.sparse.issparse(gram) else np.asarray(gram)
+    basis_cov = gram / n - np.outer(mean, mean)
+
+    # block matrix with the coefficient block of term i in column i, zeros elsewhere
+    coef_blocks = np.zeros((len(gam.coef_), n_terms))
+    for i in range(n_terms):
+        idxs = gam.terms.get_coef_indices(i)
+        coef_blocks[idxs, i] = gam.coef_[idxs]
+
+    # all quadratic forms b_i^T Cov(B) b_i in one call
+    variances = np.einsum("pi,pq,qi->i", coef_blocks, basis_cov, coef_blocks)
+
+    # clip tiny negative values caused by rounding
+    return np.clip(variances, 0, None)
+
+
+def term_p_values(gam, n_terms):
+    """
+    Wald test for each term function being zero, using the coefficient covariance of the GAM
+    (Wood 2006, section 4.8.5 - as in pygam, the p-values tend to be too low if smoothing parameters were estimated)
+    :param gam: fitted GAM
+    :param n_terms: number of (feature) terms to test, the terms have to be the first n_terms terms of the GAM
+    :return: np.array of shape (n_terms,) with the p-value of each term
+    """
+
+    p_values = np.zeros(n_terms)
+
+    for i in range(n_terms):
+        idxs = gam.terms.get_coef_indices(i)
+        cov = gam.statistics_["cov"][idxs][:, idxs]
+        coef = gam.coef_[idxs].copy()
+
+        # center spline term functions, as pygam does for its p-values
+        if isinstance(gam.terms[i], SplineTerm):
+            coef -= coef.mean()
+
+        inv_cov, rank = scipy.linalg.pinvh(cov, return_rank=True)
+        wald = coef.dot(inv_cov).dot(coef)
+
+        if gam.distribution._known_scale:
+            p_values[i] = scipy.stats.chi2.sf(wald, df=rank)
+        else:
+            # scale was estimated: use F statistic
+            p_values[i] = scipy.stats.f.sf(wald / rank, rank,
+                                           gam.statistics_["n_samples"] - gam.statistics_["edof"])
+
+    return p_values
+
+
+def check_nullification_analytic(full_gam, X, feature_combination_full, threshold=1e-7, alpha=None, modelmat=None):
+    """
+    Check for nullification of features in GAM using the standard deviation of each term function over the
+    empirical feature distribution, computed analytically from the coefficients (see term_variances()).
+    Unlike check_nullification() the result does not depend on a grid resolution.
+    :param full_gam: GAM, ideally trained on all features
+    :param X: data the GAM was trained on in shape (n_samples, m_features)
+    :param feature_combination_full: list of all features in GAM
+    :param threshold: (user-)defined std threshold for nullification
+    :param alpha: if given: additionally treat terms as nullified whose Wald test p-value is >= alpha
+    :param modelmat: precomputed model matrix of full_gam at X, computed if not given
+    :return: list of nullified features
+    """
+
+    if modelmat is None:
+        modelmat = full_gam._modelmat(X)
+
+    n_terms = len(feature_combination_full)
+    nullified = np.sqrt(term_variances(full_gam, modelmat, n_terms)) < threshold
+
+    if alpha is not None:
+        nullified |= term_p_values(full_gam, n_terms) >= alpha
+
+    return [feature_combination_full[i] for i in range(n_terms) if nullified[i]]
+
+
+def influence(gam, modelmat, mu, weights):
+    """
+    Computes the diagonal of the influence (hat) matrix of the final PIRLS iteration of a fitted GAM:
+    h_ii = w_i^2 * b_i^T (B^T W^2 B + P)^-1 b_i with the same penalties and conditioning as in GAM._pirls()
+    :param gam: fitted GAM
+    :param modelmat: model matrix of the GAM evaluated at the training data, e.g. gam._modelmat(X)
+    :param mu: expected value of the targets given the GAM
+    :param weights: sample weights
+    :return: np.array of shape (n_samples) with the influence of each sample, sums up to the edof
+    """
+
+    w = gam._W(mu, weights).diagonal()
+    m = modelmat.shape[1]
+
+    penalties = gam._P() + scipy.sparse.diags(np.ones(m) * np.sqrt(np.finfo(np.float64).eps))
+    if gam.terms.hasconstraint:
+        penalties = penalties + gam._C()
+
+    WB = scipy.sparse.diags(w).dot(modelmat)
+    hessian = WB.T.dot(WB) + penalties
+    hessian = hessian.toarray() if scipy.sparse.issparse(hessian) else np.asarray(hessian)
+
+    # b_i^T H^-1 b_i for all samples at once
+    BH = scipy.linalg.solve(hessian, WB.T.toarray() if scipy.sparse.issparse(WB) else WB.T, assume_a="pos").T
+
+    return np.asarray(WB.multiply(BH).sum(axis=1)).ravel() if scipy.sparse.issparse(WB) \
+        else (WB * BH).sum(axis=1)
+
+
+def validated_score(gam, X, y, method="loo"):
+    """
+    Compute the deviance explained of a GAM validated on left-out data, without refitting the GAM
+    :param gam: fitted GAM for which to compute the validated deviance explained
+    :param X: Training vectors in shape (n_samples, m_features)
+    :param y: Target values in shape (n_samples)
+    :param method: "loo": leave-one-out deviance from the influence of each sample (see influence()):
+                        the leave-one-out linear predictor of the final PIRLS iteration is
+                        lp_i - h_ii / (1 - h_ii) * (z_i - lp_i) with pseudo data z,
+                        this is exact for a normal distribution with identity link
+                    "gcv": deviance scaled by the GCV factor n^2 / (n - edof)^2
+    :return: validated deviance explained
+    """
+
+    weights = np.ones_like(y).astype("float64")
+
+    modelmat = gam._modelmat(X)
+    lp = gam._linear_predictor(modelmat=modelmat)
+    mu = gam.link.mu(lp, gam.distribution)
+
+    # same null model as in GAM._estimate_r2()
+    null_mu = y.mean() * np.ones_like(y).astype("float64")
+    null_d = gam.distribution.deviance(y=y, mu=null_mu, weights=weights).sum()
+
+    if method == "gcv":
+        n = len(y)
+        full_d = gam.distribution.deviance(y=y, mu=mu, weights=weights).sum() * n ** 2 \
+                 / (n - gam.statistics_["edof"]) ** 2
+
+    elif method == "loo":
+        # samples that determine their own fit completely (h_ii = 1) get a large, but finite leave-one-out residual
+        h = np.minimum(influence(gam, modelmat, mu, weights), 1 - np.sqrt(np.finfo(np.float64).eps))
+        loo_lp = lp - h / (1 - h) * (gam._pseudo_data(y, lp, mu) - lp)
+        full_d = gam.distribution.deviance(y=y, mu=gam.link.mu(loo_lp, gam.distribution), weights=weights).sum()
+
+    else:
+        raise ValueError(f"Unknown validation method {method}, please use 'loo' or 'gcv'")
+
+    return 1.0 - full_d / null_d
+
+
 def score(gam, X, y):
     """
     Compute the deviance explained for a given GAM
@@ -2,6 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from ast import literal_eval
 from math import ceil
+import json
 import scipy
 
 
@@ -20,20 +21,50 @@ def plot_decision_funct(ax, dec_funct, index, feature=None):
     :return:
     """
 
+    draw_decision_funct(ax, decision_onsets(dec_funct, index, feature))
+
+
+def decision_onsets(dec_funct, index, feature=None):
+    """
+    Computes what is needed to draw the decision function for one subplot
+    :param dec_funct: dictionary encoding the decision function, see plot_decision_funct()
+    :param index: index/indices of feature in GAM term
+    :param feature: name/ list of names of feature
+    :return: dictionary with
+            - onsets: onset array from create_onset_array()
+            - targets: sorted target values of the decision function
+            - n_indices: number of categorical features in the subplot, None for a numerical feature
+    """
+
     if isinstance(index, list):
         decision_arr = create_onset_array(dec_funct) # categorical features (e.g. strings) as values in  dec_funct
     else:
         decision_arr = create_onset_array(dec_funct, feature) # create onset for specific feature
 
+    return {"onsets": decision_arr,
+            "targets": sorted(dec_funct.keys()),
+            "n_indices": len(index) if isinstance(index, list) else None}
+
+
+def draw_decision_funct(ax, decision):
+    """
+    Draws the decision function onto an axis
+    :param ax: Axes to plot the decision function onto
+    :param decision: dictionary from decision_onsets()
+    :return:
+    """
+
+    decision_arr = decision["onsets"]
+
     y1, y2 = ax.get_ylim()
     for i in range(len(decision_arr)):
         if decision_arr[i] is not None:
             ax.vlines(decision_arr[i], y1, y2, colors='k', linestyles='dashed', label='Theoretical')
 
-    if isinstance(index, list):
+    if decision["n_indices"] is not None:
         # categorical features: plot a step function
         steps = np.arange(len(decision_arr))
-        if len(decision_arr) < len(index):
+        if len(decision_arr) < decision["n_indices"]:
             steps = [i for i in range(len(decision_arr)) for item in decision_arr[i]]
         ax.step(np.arange(len(steps)), steps, where="mid",
                 color='k', linestyle='dashed',
@@ -41,10 +72,10 @@ def plot_decision_funct(ax, dec_funct, index, feature=None):
     else:
         #if there are holes in the onset array/decision function: remove them
         if np.any(decision_arr==None):
-            y_indices = np.array(sorted(dec_funct.keys()))[np.argwhere(decision_arr!=None)]
+            y_indices = np.array(decision["targets"])[np.argwhere(decision_arr!=None)]
             decision_arr = decision_arr[np.argwhere(decision_arr!=None)]
         else:
-            y_indices = sorted(dec_funct.keys())
+            y_indices = decision["targets"]
 
         #if onset array is ascending: achieve end values of each target value by shifting to the right
         if decision_arr[0] < decision_arr[1]:
@@ -65,7 +96,8 @@ def plot_decision_funct(ax, dec_funct, index, feature=None):
 
 
 
-def plot_gam_terms(cfg, gam, features, circular_features=None, correct_offset=True,title=None, decision_funct=None, logistic=False):
+def plot_gam_terms(cfg, gam, features, circular_features=None, correct_offset=True,title=None, decision_funct=None, logistic=False,
+                   export_path=None):
     """
     Plot term functions for a GAM
     :param cfg: dictionary with plot specifications
@@ -77,48 +109,114 @@ def plot_gam_terms(cfg, gam, features, circular_features=None, correct_offset=Tr
     :param title: Title for plot
     :param decision_funct: dictionary with decision function, if given: must be defined for all features
     :param logistic: whether GAM is a LogisticGAM
+    :param export_path: if given: path to export the term curves to, see export_term_curves()
     :return:
     """
 
+    curves = term_curves(cfg, gam, features, circular_features=circular_features, correct_offset=correct_offset,
+                         title=title, decision_funct=decision_funct, logistic=logistic)
+
+    if export_path:
+        export_term_curves(curves, export_path)
+
+    draw_term_curves(curves)
+    plt.show()
+
+
+def term_curves(cfg, gam, features, circular_features=None, correct_offset=True,title=None, decision_funct=None, logistic=False):
+    """
+    Computes everything that is needed to draw the term functions of a GAM, so that they can be drawn
+    (see draw_term_curves()) or exported (see export_term_curves()) without the GAM
+    :param cfg: dictionary with plot specifications
+            -> Circularity_Test.config["plot"]
+    :param gam: GAM for which to compute the term functions
+    :param features: list of feature names
+    :param circular_features: list of names of circular features
+    :param correct_offset: whether to add/ correct the offset in plots for a nicer presentation
+    :param title: Title for plot
+    :param decision_funct: dictionary with decision function, if given: must be defined for all features
+    :param logistic: whether GAM is a LogisticGAM
+    :return: dictionary with title, ylim, label and a list with one dictionary per subplot containing
+            grid, curve, confidence band, offset and decision function onsets
+    """
+
     # Rearrange order of features -> combine and order
     titles, indices = sort_preprocess_smooth_plots(cfg, features, circular_features)
 
-    x_plt = 2 if len(titles) > 3 else 1
-    y_plt = ceil(len(titles) / x_plt)
-    fig, axs = plt.subplots(x_plt, y_plt, sharey=True, squeeze=False)
-
+    ylim = None
     if "ylim" in cfg:
         if isinstance(cfg["ylim"], str):
-            y1, y2 = literal_eval(cfg["ylim"])
+            ylim = literal_eval(cfg["ylim"])
         else:
-            y1, y2 = cfg["ylim"]
-        plt.ylim(y1, y2)
+            ylim = cfg["ylim"]
 
     offsets = [0]*len(titles)
     if correct_offset:
         correct_offsets(cfg, offsets, gam, titles, indices, circular_features)
 
-    for i, ax in enumerate(axs.reshape(-1)[:len(titles)]):
+    subplots = []
+    for i in range(len(titles)):
 
         if isinstance(indices[i], list):
-            plot_categorical_terms(cfg, ax, indices[i], gam, offset=offsets[i],
-                                   xtick_names=[features[j] for j in indices[i]], title=titles[i],
-                                   label="Estimated" if decision_funct else "", logistic=logistic)
+            curve = categorical_term_curve(gam, indices[i], logistic=logistic)
+            curve["xtick_names"] = [features[j] for j in indices[i]]
         else:
-            plot_smooth_terms(cfg, ax, indices[i],  gam, offset=offsets[i], feature=titles[i], title=titles[i],
-                              label="Estimated" if decision_funct else "", logistic=logistic)
+            curve = smooth_term_curve(cfg, gam, indices[i], feature=titles[i], logistic=logistic)
+
+        curve["title"] = titles[i]
+        curve["offset"] = float(offsets[i])
+
         if decision_funct:
-            plot_decision_funct(ax, decision_funct,feature=titles[i], index=indices[i])
+            curve["decision"] = decision_onsets(decision_funct, feature=titles[i], index=indices[i])
+
+        subplots.append(curve)
+
+    return {"title": title,
+            "ylim": list(ylim) if ylim is not None else None,
+            "label": "Estimated" if decision_funct else "",
+            "subplots": subplots}
+
+
+def draw_term_curves(curves, confidence=False):
+    """
+    Draws term functions from precomputed term curves, does not need the GAM
+    :param curves: dictionary from term_curves() or load_term_curves()
+    :param confidence: whether to draw the confidence bands of the term functions
+    :return: Figure
+    """
+
+    subplots = curves["subplots"]
+
+    x_plt = 2 if len(subplots) > 3 else 1
+    y_plt = ceil(len(subplots) / x_plt)
+    fig, axs = plt.subplots(x_plt, y_plt, sharey=True, squeeze=False)
+
+    if curves["ylim"] is not None:
+        y1, y2 = curves["ylim"]
+        plt.ylim(y1, y2)
+
+    for i, ax in enumerate(axs.reshape(-1)[:len(subplots)]):
+
+        if subplots[i]["kind"] == "categorical":
+            draw_categorical_term(ax, subplots[i], offset=subplots[i]["offset"],
+                                  xtick_names=subplots[i]["xtick_names"], title=subplots[i]["title"],
+                                  label=curves["label"], confidence=confidence)
+        else:
+            draw_smooth_term(ax, subplots[i], offset=subplots[i]["offset"], title=subplots[i]["title"],
+                             label=curves["label"], confidence=confidence)
+        if subplots[i].get("decision"):
+            draw_decision_funct(ax, subplots[i]["decision"])
 
     #delete empty subplots
-    if len(titles) < len(axs.reshape(-1)):
-        for ax in axs.reshape(-1)[len(titles):]: ax.remove()
+    if len(subplots) < len(axs.reshape(-1)):
+        for ax in axs.reshape(-1)[len(subplots):]: ax.remove()
 
-    if title:
-        plt.suptitle(title)
+    if curves["title"]:
+        plt.suptitle(curves["title"])
 
     plt.tight_layout()
-    plt.show()
+
+    return fig
 
 
 def plot_categorical_terms(cfg, ax, indices, gam, offset=0, xtick_names=None, title=None, label=None, logistic=False):
@@ -137,26 +235,63 @@ def plot_categorical_terms(cfg, ax, indices, gam, offset=0, xtick_names=None, ti
     :return:
     """
 
+    draw_categorical_term(ax, categorical_term_curve(gam, indices, logistic=logistic), offset=offset,
+                          xtick_names=xtick_names, title=title, label=label)
+
+
+def categorical_term_curve(gam, indices, logistic=False):
+    """
+    Computes the step function for one or more categorical/linear data terms
+    :param gam: GAM for which to compute the terms
+    :param indices: list of indices which given features have in GAM term
+    :param logistic: whether GAM is a LogisticGAM
+    :return: dictionary with value of each step ("y") and its confidence band ("lower", "upper"),
+            the first step is the value without any feature (0)
+    """
+
     smooth_t = np.zeros((100, len(indices) + 1))
+    confi_t = np.zeros((100, len(indices) + 1, 2))
 
     for j in range(len(indices)):
         XX = gam.generate_X_grid(term=indices[j])
+        pdep, confi = gam.partial_dependence(term=int(indices[j]), X=XX, width=0.95)
         if logistic:
-            smooth_t[:, j + 1] = scipy.stats.norm.cdf(gam.partial_dependence(term=int(indices[j]), X=XX))
-        else:
-            smooth_t[:, j + 1] = gam.partial_dependence(term=int(indices[j]), X=XX)
+            pdep, confi = scipy.stats.norm.cdf(pdep), scipy.stats.norm.cdf(confi)
+        smooth_t[:, j + 1] = pdep
+        confi_t[:, j + 1] = confi
 
     # assuming that each individual feature has just 2 possible values:
     # 0 and x: x will be the last value in grid, everything in between
     # are values that feature never has in data
-    ax.step(np.arange(0, len(indices) +1 ), smooth_t[-1, :] + offset, where="mid", label=label)
+    return {"kind": "categorical", "y": smooth_t[-1, :], "lower": confi_t[-1, :, 0], "upper": confi_t[-1, :, 1]}
+
+
+def draw_categorical_term(ax, curve, offset=0, xtick_names=None, title=None, label=None, confidence=False):
+    """
+    Draws a precomputed step function (see categorical_term_curve()) in Axes subplot
+    :param ax: Axes to plot the terms onto
+    :param curve: dictionary from categorical_term_curve()
+    :param offset: offset to add to term function
+    :param xtick_names: names that individual categorical features have to display on x axis
+    :param title: title for the subplot
+    :param label: label for the term function
+    :param confidence: whether to draw the confidence band
+    :return:
+    """
 
-    ax.set_xticks(np.arange(0, len(indices) +1))
+    steps = np.arange(0, len(curve["y"]))
+
+    ax.step(steps, curve["y"] + offset, where="mid", label=label)
+
+    if confidence:
+        ax.fill_between(steps, curve["lower"] + offset, curve["upper"] + offset, step="mid", alpha=0.3)
+
+    ax.set_xticks(steps)
 
     if xtick_names:
         ax.set_xticklabels(["None"] + list(xtick_names), rotation=65)
 
-    ax.hlines(0, 0, len(indices), colors="k", linestyles='dashed', label='')
+    ax.hlines(0, 0, len(curve["y"]) - 1, colors="k", linestyles='dashed', label='')
 
     if title:
         ax.set_title(title)
@@ -176,6 +311,23 @@ def plot_smooth_terms(cfg, ax, index, gam, offset=0, feature=None, title=None, l
     :param logistic: whether GAM is a LogisticGAM
     :return:
     """
+
+    draw_smooth_term(ax, smooth_term_curve(cfg, gam, index, feature=feature, logistic=logistic), offset=offset,
+                     title=title, label=label)
+
+
+def smooth_term_curve(cfg, gam, index, feature=None, logistic=False):
+    """
+    Computes the term function of a spline term on a grid
+    :param cfg: dictionary with plot specifications
+            -> Circularity_Test.config["plot"]
+    :param gam: GAM for which to compute the term function
+    :param index: index of give feature in GAM term
+    :param feature: name of feature
+    :param logistic: whether GAM is a LogisticGAM
+    :return: dictionary with grid ("x"), term function ("y"), its confidence band ("lower", "upper"),
+            x limits ("xlim") and whether they are set explicitly ("set_xlim")
+    """
     n = (cfg.get(feature) or {}).get("n", 100) if feature in cfg else 100
 
     XX = gam.generate_X_grid(term=index, n=n)
@@ -188,14 +340,38 @@ def plot_smooth_terms(cfg, ax, index, gam, offset=0, feature=None, title=None, l
             x1, x2 = xlim
         else:
             x1, x2 = np.amin(XX[:, index]), np.amax(XX[:, index])
-        ax.set_xlim(x1, x2)
     else:
         x1, x2 = np.amin(XX[:, index]), np.amax(XX[:, index])
 
+    pdep, confi = gam.partial_dependence(term=int(index), X=XX, width=0.95)
+
     if logistic:
-        ax.plot(XX[:, index], scipy.stats.norm.cdf(gam.partial_dependence(term=int(index), X=XX)) +offset, label=label)
-    else:
-        ax.plot(XX[:, index], gam.partial_dependence(term=int(index), X=XX) +offset, label=label)
+        pdep, confi = scipy.stats.norm.cdf(pdep), scipy.stats.norm.cdf(confi)
+
+    return {"kind": "smooth", "x": XX[:, index], "y": pdep, "lower": confi[:, 0], "upper": confi[:, 1],
+            "xlim": [float(x1), float(x2)], "set_xlim": feature in cfg}
+
+
+def draw_smooth_term(ax, curve, offset=0, title=None, label=None, confidence=False):
+    """
+    Draws a precomputed term function (see smooth_term_curve()) in Axes subplot
+    :param ax: Axes to plot the term onto
+    :param curve: dictionary from smooth_term_curve()
+    :param offset: offset to add to term function
+    :param title: title for subplot
+    :param label: label for the term function
+    :param confidence: whether to draw the confidence band
+    :return:
+    """
+
+    x1, x2 = curve["xlim"]
+    if curve["set_xlim"]:
+        ax.set_xlim(x1, x2)
+
+    ax.plot(curve["x"], curve["y"] +offset, label=label)
+
+    if confidence:
+        ax.fill_between(curve["x"], curve["lower"] + offset, curve["upper"] + offset, alpha=0.3)
 
     ax.hlines(0, x1, x2, colors="k", linestyles='dashed', label='')
 
@@ -203,6 +379,76 @@ def plot_smooth_terms(cfg, ax, index, gam, offset=0, feature=None, title=None, l
         ax.set_title(title)
 
 
+def export_term_curves(curves, path):
+    """
+    Exports term curves to a compact NPZ file, so that the plot can be rendered without the GAM or pygam,
+    see render_term_curves()
+    :param curves: dictionary from term_curves()
+    :param path: path of the NPZ file
+    :return:
+    """
+
+    arrays = {}
+    subplots = []
+
+    for i, curve in enumerate(curves["subplots"]):
+        meta = {k: v for k, v in curve.items() if k not in ["x", "y", "lower", "upper", "decision"]}
+
+        for key in ["x", "y", "lower", "upper"]:
+            if key in curve:
+                arrays[f"{key}_{i}"] = np.asarray(curve[key], dtype="float64")
+
+        if curve.get("decision"):
+            onsets = curve["decision"]["onsets"]
+            meta["decision"] = dict(curve["decision"],
+                                    onsets=onsets.tolist() if isinstance(onsets, np.ndarray) else onsets,
+                                    onsets_array=isinstance(onsets, np.ndarray))
+
+        subplots.append(meta)
+
+    meta = {"title": curves["title"], "ylim": curves["ylim"], "label": curves["label"], "subplots": subplots}
+
+    np.savez_compressed(path, meta=np.array(json.dumps(meta, default=float)), **arrays)
+
+
+def load_term_curves(path):
+    """
+    Loads term curves exported with export_term_curves()
+    :param path: path of the NPZ file
+    :return: dictionary like from term_curves()
+    """
+
+    with np.load(path, allow_pickle=False) as npz:
+        curves = json.loads(str(npz["meta"]))
+
+        for i, curve in enumerate(curves["subplots"]):
+            for key in ["x", "y", "lower", "upper"]:
+                if f"{key}_{i}" in npz:
+                    curve[key] = npz[f"{key}_{i}"]
+
+            if curve.get("decision") and curve["decision"].pop("onsets_array"):
+                curve["decision"]["onsets"] = np.array(curve["decision"]["onsets"])
+
+    return curves
+
+
+def render_term_curves(path, confidence=False, show=True):
+    """
+    Renders the term functions exported with export_term_curves() without the GAM
+    :param path: path of the NPZ file
+    :param confidence: whether to draw the confidence bands of the term functions
+    :param show: whether to show the figure
+    :return: Figure
+    """
+
+    fig = draw_term_curves(load_term_curves(path), confidence=confidence)
+
+    if show:
+        plt.show()
+
+    return fig
+
+
 def sort_preprocess_smooth_plots(cfg, features, circular_features=None):
     """
     Preprocesses the order and content of smooth plot subplots
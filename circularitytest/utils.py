@@ -1,5 +1,16 @@
 import yaml
 import pyreadr
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+# format of the cached preprocessed data (see load_data()), part of the cache key: increase it when the cached
+# arrays or the preprocessing change, so that old cache files are not used anymore
+DATA_CACHE_FORMAT = 1
 
 
 def load_config(config_path="configs/ir_example.yaml"):
@@ -57,11 +68,132 @@ def preprocess_replace_data(df, cfg):
     :return: DataFrame with converted columns
     """
 
-    df[cfg["columns"]] = df[cfg["columns"]].replace(cfg["replace"])
+    arrays = compile_preprocessing({"data": {"preprocess": cfg}}, cfg["columns"])(df)
+    for col in cfg["columns"]:
+        df[col] = arrays[col]
 
     return df
 
 
+def compile_preprocessing(cfg, columns):
+    """
+    Compiles the preprocessing in cfg["data"] ("preprocess" and "binarize") into a single vectorised transform
+    that only touches the given columns and the columns they are computed from:
+        - replacements are looked up on the category codes of a column instead of replacing object values
+        - "combine" and binarization are computed on the resulting arrays
+    preprocess_replace_data() and binarize_features() apply the same transform to a whole DataFrame.
+    :param cfg: dictionary with specifications about data, see load_data()
+            -> Circularity_Test.config
+    :param columns: names of columns to output, e.g. features and targets
+    :return: function that transforms a DataFrame into a dictionary {column name: np.array}
+    """
+
+    preprocess = cfg["data"].get("preprocess") or {}
+    replace_columns = set(preprocess.get("columns", []))
+    replace = preprocess.get("replace", {})
+
+    binarize = cfg["data"].get("binarize") or {}
+    binarize_columns = set(binarize.get("columns", []))
+    combine = binarize.get("combine") or {}
+
+    def transform(df):
+
+        arrays = {}
+
+        def replaced(name):
+            if name not in arrays:
+                if name in replace_columns:
+                    # one lookup per category instead of per value, code -1 (missing value) maps to the last entry
+                    codes, uniques = pd.factorize(df[name])
+                    lookup = pd.Series([replace.get(value, value) for value in uniques] + [np.nan]).to_numpy()
+                    arrays[name] = lookup[codes]
+                else:
+                    arrays[name] = df[name].to_numpy()
+            return arrays[name]
+
+        if combine:
+            # combine before binarization, like binarize_features()
+            combined = np.nansum(np.column_stack([replaced(col).astype("float64") for col in combine["columns"]]),
+                                 axis=1)
+
+        output = {}
+        for name in columns:
+            values = combined if combine and name == combine["name"] else replaced(name)
+
+            if name in binarize_columns:
+                values = np.where(values == 0., values, 1.0)
+
+            output[name] = values
+
+        return output
+
+    return transform
+
+
+def data_cache_key(path, cfg):
+    """
+    Computes the key for the preprocessed data of a data file from the hash of the raw file,
+    the preprocessing specification and the cache format (DATA_CACHE_FORMAT)
+    :param path: path to the raw data file
+    :param cfg: dictionary with specifications about data, see load_data()
+            -> Circularity_Test.config
+    :return: hex string
+    """
+
+    key = hashlib.sha256()
+
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            key.update(chunk)
+
+    spec = {"format": DATA_CACHE_FORMAT,
+            "preprocess": cfg["data"].get("preprocess"),
+            "binarize": cfg["data"].get("binarize"),
+            "features": list(cfg["features"]) if "features" in cfg else None,
+            "target": cfg["target"]}
+    key.update(json.dumps(spec, sort_keys=True, default=str).encode("utf-8"))
+
+    return key.hexdigest()
+
+
+def save_data_cache(cache_path, X, y, features):
+    """
+    Writes preprocessed data to the cache atomically: the file is written under a temporary name in the cache
+    directory and then renamed, so that an interrupted run or a concurrent reader never sees a partial file
+    :param cache_path: path of the .npz cache file, see data_cache_key()
+    :param X: np.array with features in shape (n_samples, n_features)
+    :param y: np.array with targets in shape (n_samples, n_targets)
+    :param features: list of feature names
+    """
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".npz.tmp", dir=os.path.dirname(cache_path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            np.savez(fp, X=X, y=y, features=np.array(features))
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def to_data_part(X, features, y, target):
+    """
+    Builds the [features, target] pair that load_data() returns for each data part
+    :param X: np.array with features in shape (n_samples, n_features)
+    :param features: list of feature names
+    :param y: np.array with targets in shape (n_samples, n_targets)
+    :param target: name or list of names of target column(s)
+    :return: [DataFrame, Series (single target)/ DataFrame (list of targets)]
+    """
+
+    if isinstance(target, list):
+        y = pd.DataFrame(y, columns=target)
+    else:
+        y = pd.Series(y[:, 0], name=target)
+
+    return [pd.DataFrame(X, columns=features), y]
+
+
 def load_data(cfg):
     """
     Load and preprocess data from given data_paths
@@ -71,6 +203,7 @@ def load_data(cfg):
                     - "preprocess: dictionary with preprocessing information, e.g.
                                 "preprocess: {"columns": ["cited_inventor", "cited_examiner", "cited_family"],
                                                 "replace":{"no": 0 , "yes": 1 }}
+                    - "cache": directory to cache the preprocessed data in, e.g. "data/cache"
             - "features": list or dictionary with all feature names;
                             if dictionary: each feature contains dictionary with GAM term specifications, please
                             refer to circularitytest.gam.construct_gam_term() and https://pygam.readthedocs.io/en/latest/api/api.html#terms
@@ -83,21 +216,42 @@ def load_data(cfg):
 
     data = {}
 
+    targets = cfg["target"] if isinstance(cfg["target"], list) else [cfg["target"]]
+
     for part in [path for path in path_names if path in cfg["data"]]:
 
+        cache_path = None
+        if "cache" in cfg["data"]:
+            cache_path = os.path.join(cfg["data"]["cache"], f"{data_cache_key(cfg['data'][part], cfg)}.npz")
+
+            if os.path.exists(cache_path):
+                with np.load(cache_path, allow_pickle=False) as cached:
+                    X, y, features = cached["X"], cached["y"], list(cached["features"])
+
+                if "features" not in cfg and part == "train":
+                    cfg["features"] = features
+
+                data[part] = to_data_part(X, features, y, cfg["target"])
+                continue
+
         df = load_r_data(cfg["data"][part])
 
         if "features" not in cfg and part == "train":
             # set missing features attribute here so that file needs to be loaded only once
             cfg["features"] = sorted(list(df.columns.drop(cfg["target"])))
 
-        if "preprocess" in cfg["data"].keys():
-            df = preprocess_replace_data(df, cfg["data"]["preprocess"])
+        features = list(cfg["features"])
+
+        arrays = compile_preprocessing(cfg, features + targets)(df)
+
+        X = np.column_stack([arrays[feature] for feature in features]).astype("float64")
+        y = np.column_stack([arrays[target] for target in targets])
 
-        if "binarize" in cfg["data"].keys():
-            df = binarize_features(df, cfg["data"]["binarize"])
+        if cache_path:
+            os.makedirs(cfg["data"]["cache"], exist_ok=True)
+            save_data_cache(cache_path, X, y, features)
 
-        data[part] = [df[cfg["features"]], df[cfg["target"]]]
+        data[part] = to_data_part(X, features, y, cfg["target"])
 
     return data
 
@@ -115,42 +269,46 @@ def binarize_features(df, cfg):
     :return: DataFrame
     """
 
-    if "combine" in cfg.keys():
-        df[cfg["combine"]["name"]] = df[cfg["combine"]["columns"]].sum(axis=1)
-
-    for col in cfg["columns"]:
-        df[col].where(df[col] == 0., 1.0, inplace=True)
+    columns = list(cfg["columns"]) + ([cfg["combine"]["name"]] if "combine" in cfg.keys() else [])
+    arrays = compile_preprocessing({"data": {"binarize": cfg}}, columns)(df)
+    for col in columns:
+        df[col] = arrays[col]
 
     return df
 
 def manage_plotting(circularity_test):
     """
     Handles the plotting as specified in Circularity_Test.config, default: plot gam with all features
+    If several targets are given, the plots are made for each target.
     :param circularity_test: Circularity_Test object with config
     :return:
     """
     print("Plotting visualizations ...")
-    if (circularity_test.config.get("plot") or {}).get("types"):
-        for element in circularity_test.config["plot"]["types"]:
-            if element == "circular":
-                if not circularity_test.circular_features:
-                    print("Sorry, plotting the circular features is only possible if circular features were found.")
-                else:
-                    circularity_test.plot_term_functions(circularity_test.circular_features)
-            elif element == "non-circular" or element == "non_circular":
-                circularity_test.plot_term_functions(
-                    [feat for feat in circularity_test.full_features if feat not in circularity_test.circular_features])
-            elif element == "all":
-                circularity_test.plot_term_functions(circularity_test.full_features)
-            elif element == "decision_function" or element == "decision-function":
-                if circularity_test.circular_features and circularity_test.config.get("decision_function") :
-                    circularity_test.plot_term_functions(circularity_test.circular_features, decision_funct=True)
-                else:
-                    print("Sorry, plotting the decision function is only possible against the circular features.")
-
-    #default is to just plot term functions of gam with all features
-    else:
-        circularity_test.plot_term_functions(circularity_test.full_features)
+    for target in circularity_test.targets:
+        circular_features = circularity_test.circular_features_per_target.get(target, [])
+
+        if (circularity_test.config.get("plot") or {}).get("types"):
+            for element in circularity_test.config["plot"]["types"]:
+                if element == "circular":
+                    if not circular_features:
+                        print("Sorry, plotting the circular features is only possible if circular features were found.")
+                    else:
+                        circularity_test.plot_term_functions(circular_features, target=target)
+                elif element == "non-circular" or element == "non_circular":
+                    circularity_test.plot_term_functions(
+                        [feat for feat in circularity_test.full_features if feat not in circular_features],
+                        target=target)
+                elif element == "all":
+                    circularity_test.plot_term_functions(circularity_test.full_features, target=target)
+                elif element == "decision_function" or element == "decision-function":
+                    if circular_features and circularity_test.config.get("decision_function") :
+                        circularity_test.plot_term_functions(circular_features, decision_funct=True, target=target)
+                    else:
+                        print("Sorry, plotting the decision function is only possible against the circular features.")
+
+        #default is to just plot term functions of gam with all features
+        else:
+            circularity_test.plot_term_functions(circularity_test.full_features, target=target)
 
 
 if __name__ == "__main__":
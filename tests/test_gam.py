@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pytest
+from pygam import GAM, s, f
+
+from circularitytest.gam import build_gam, construct_gam_term, fit_chunked, fit_multi_target, fit_sparse, \
+    validated_score
+from circularitytest.utils import load_config, load_data
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def synthetic_data(distribution, n=600, n_targets=1, seed=0):
+    """
+    Two smooth features and one categorical feature with normal or binomial targets
+    """
+
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([rng.uniform(0, 1, n), rng.uniform(-1, 1, n), rng.integers(0, 3, n)])
+
+    Y = []
+    for j in range(n_targets):
+        lp = np.sin(3 * X[:, 0] + j) + X[:, 1] ** 2 + 0.5 * X[:, 2]
+        if distribution == "normal":
+            Y.append(lp + rng.normal(0, 0.3, n))
+        else:
+            Y.append((rng.uniform(size=n) < 1 / (1 + np.exp(1 - lp))).astype(float))
+
+    return X, np.column_stack(Y)
+
+
+def synthetic_gam(distribution):
+    return GAM(s(0, n_splines=12) + s(1, n_splines=8) + f(2), distribution=distribution,
+               link="identity" if distribution == "normal" else "logit")
+
+
+@pytest.mark.parametrize("distribution", ["normal", "binomial"])
+def test_fit_multi_target_matches_gam_fit(distribution):
+    X, Y = synthetic_data(distribution, n_targets=3)
+    gam = synthetic_gam(distribution)
+
+    for j, fitted in enumerate(fit_multi_target(gam, X, Y)):
+        reference = synthetic_gam(distribution).fit(X, Y[:, j])
+
+        np.testing.assert_allclose(fitted.predict(X), reference.predict(X), rtol=1e-8, atol=1e-8)
+        assert fitted.statistics_["edof"] == pytest.approx(reference.statistics_["edof"], rel=1e-8)
+        np.testing.assert_allclose(fitted.statistics_["cov"], reference.statistics_["cov"], rtol=1e-6, atol=1e-10)
+        assert fitted.statistics_["pseudo_r2"]["explained_deviance"] == \
+            pytest.approx(reference.statistics_["pseudo_r2"]["explained_deviance"], rel=1e-8)
+
+
+@pytest.mark.parametrize("distribution", ["normal", "binomial"])
+@pytest.mark.parametrize("chunk_size", [64, 250, 600, 1000])
+def test_fit_chunked_matches_gam_fit(distribution, chunk_size):
+    X, Y = synthetic_data(distribution)
+    y = Y[:, 0]
+    reference = synthetic_gam(distribution).fit(X, y)
+
+    # an unused first column, the GAM reads the others
+    X_file = np.column_stack([np.zeros(len(X)), X])
+    fitted = fit_chunked(synthetic_gam(distribution), X_file, y, chunk_size=chunk_size, columns=[1, 2, 3])
+
+    np.testing.assert_allclose(fitted.predict(X), reference.predict(X), rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(fitted.statistics_["cov"], reference.statistics_["cov"], rtol=1e-4, atol=1e-8)
+    for statistic in ["edof", "scale", "AIC", "loglikelihood", "deviance"]:
+        assert fitted.statistics_[statistic] == pytest.approx(reference.statistics_[statistic], rel=1e-6)
+    assert fitted.statistics_["pseudo_r2"]["explained_deviance"] == \
+        pytest.approx(reference.statistics_["pseudo_r2"]["explained_deviance"], rel=1e-6)
+    assert len(fitted.logs_["diffs"]) == len(reference.logs_["diffs"])
+
+
+# the bases of the splines are collinear with the intercept, so the coefficients are only compared via predictions
+@pytest.mark.parametrize("distribution", ["normal", "binomial"])
+@pytest.mark.parametrize("dtype, tolerance", [("float64", 1e-7), ("float32", 1e-4)])
+@pytest.mark.parametrize("block_size", [64, 1024])
+def test_fit_sparse_matches_gam_fit(distribution, dtype, tolerance, block_size):
+    X, Y = synthetic_data(distribution)
+    y = Y[:, 0]
+    reference = synthetic_gam(distribution).fit(X, y)
+
+    fitted = fit_sparse(synthetic_gam(distribution), X, y, dtype=dtype, block_size=block_size)
+
+    assert fitted.logs_["diffs"][-1] < fitted.tol
+    np.testing.assert_allclose(fitted.predict(X), reference.predict(X), rtol=tolerance, atol=tolerance)
+    assert fitted.statistics_["edof"] == pytest.approx(reference.statistics_["edof"], rel=tolerance)
+    assert fitted.statistics_["pseudo_r2"]["explained_deviance"] == \
+        pytest.approx(reference.statistics_["pseudo_r2"]["explained_deviance"], abs=tolerance)
+
+
+# a weight of zero leaves the sample out of the fit, but not out of the data-dependent parameters (edge knots),
+# so the refits use the same bases as the fit on all samples
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("distribution, tolerance", [("normal", 1e-8), ("binomial", 1e-2)])
+def test_loo_validated_score_matches_refits(distribution, tolerance):
+    X, Y = synthetic_data(distribution, n=120)
+    y = Y[:, 0]
+    gam = synthetic_gam(distribution).fit(X, y)
+
+    loo_mu = np.empty(len(y))
+    for i in range(len(y)):
+        weights = np.ones(len(y))
+        weights[i] = 0
+        loo_mu[i] = synthetic_gam(distribution).fit(X, y, weights=weights).predict_mu(X[i:i + 1])[0]
+
+    null_d = gam.distribution.deviance(y=y, mu=np.full(len(y), y.mean())).sum()
+    exact = 1 - gam.distribution.deviance(y=y, mu=loo_mu).sum() / null_d
+
+    assert validated_score(gam, X, y, method="loo") == pytest.approx(exact, abs=tolerance)
+
+
+@pytest.fixture(scope="module")
+def kidney():
+    cfg = load_config(os.path.join(ROOT, "configs/kidney_sofa_dist_example.yaml"))
+    cfg["data"]["train"] = os.path.join(ROOT, cfg["data"]["train"])
+    features = list(cfg["features"])
+    X, y = load_data(cfg)["train"]
+    gam = build_gam(construct_gam_term(cfg, features, plot=True), cfg.get("GAM"))
+    return gam, X[features].to_numpy().astype(float), y.to_numpy().astype(float)
+
+
+def test_fit_sparse_float32_converges_on_kidney(kidney):
+    gam, X, y = kidney
+    reference = fit_sparse(gam, X, y, dtype="float64")
+    reduced = fit_sparse(gam, X, y, dtype="float32")
+
+    assert reference.logs_["diffs"][-1] < gam.tol
+    assert reduced.logs_["diffs"][-1] < gam.tol
+    assert len(reduced.logs_["diffs"]) <= len(reference.logs_["diffs"]) + 4
+    assert reduced.statistics_["pseudo_r2"]["explained_deviance"] == \
+        pytest.approx(reference.statistics_["pseudo_r2"]["explained_deviance"], abs=1e-6)